@@ -224,6 +224,12 @@ def enviar():
                         # Seleccionar operador
                         operador = router.obtener_operador_siguiente(0)
 
+                        if operador is None:
+                            # Circuit breaker abierto en todos: esperar sin consumir la cola
+                            logger.warning("Sin operadores disponibles, pausando campaña")
+                            time.sleep(5)
+                            break
+
                         # Enviar SMS
                         resultado = SMSSender.enviar_sms_ahora(
                             queue_id,
@@ -238,11 +244,11 @@ def enviar():
                         # Actualizar progreso
                         with proceso_lock:
                             proceso_activo["procesados"] += 1
-                            if resultado['success']:
+                            if resultado.success:
                                 proceso_activo["enviados"] += 1
                             else:
                                 proceso_activo["fallidos"] += 1
-                            proceso_activo["detalles"].append(resultado)
+                            proceso_activo["detalles"].append(resultado.to_dict())
 
                         # Rate limit global
                         rate_limiter_global.esperar()
@@ -306,12 +312,15 @@ def test_sms():
 
     # Enviar inmediatamente
     operador = router.obtener_operador_siguiente(0)
+    if operador is None:
+        return jsonify({"status": "error", "message": "Sin operadores disponibles, el SMS quedó en cola"})
+
     resultado = SMSSender.enviar_sms_ahora(queue_id, numero, mensaje, operador.operador)
 
-    if resultado['success']:
+    if resultado.success:
         return jsonify({"status": "ok", "message": "SMS enviado correctamente"})
     else:
-        return jsonify({"status": "error", "message": f"Error: {resultado.get('error', 'Desconocido')}"})
+        return jsonify({"status": "error", "message": f"Error: {resultado.error or 'Desconocido'}"})
 
 @app.route("/descargar-plantilla", methods=["GET"])
 def descargar_plantilla():
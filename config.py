@@ -3,66 +3,110 @@ Configuración centralizada del sistema SMS
 """
 
 import os
+from dataclasses import dataclass, replace
 from datetime import timedelta
+from typing import Tuple
 
+
+@dataclass(frozen=True, slots=True)
 class Config:
-    """Configuración base"""
+    """Configuración base (inmutable, variables de entorno leídas una sola vez)"""
 
     # Base de datos
-    DB_PATH = os.environ.get('SMS_DB_PATH', 'sms_marketing.db')
+    DB_PATH: str = 'sms_marketing.db'
 
     # API de acortador
-    URL_ACORTADOR = os.environ.get('URL_ACORTADOR', 'http://localhost:5001')
+    URL_ACORTADOR: str = 'http://localhost:5001'
 
     # Rate limiting
-    MAX_SMS_POR_MINUTO = int(os.environ.get('MAX_SMS_POR_MINUTO', '100'))
-    MAX_SMS_POR_SEGUNDO = int(os.environ.get('MAX_SMS_POR_SEGUNDO', '10'))
+    MAX_SMS_POR_MINUTO: int = 100
+    MAX_SMS_POR_SEGUNDO: int = 10
 
     # Reintentos
-    MAX_REINTENTOS = int(os.environ.get('MAX_REINTENTOS', '5'))
-    BACKOFF_DELAYS = [1, 5, 30, 300, 1800]  # segundos
+    MAX_REINTENTOS: int = 5
+    BACKOFF_DELAYS: Tuple[int, ...] = (1, 5, 30, 300, 1800)  # segundos
 
     # Timeout
-    TIMEOUT_API = int(os.environ.get('TIMEOUT_API_SEGUNDOS', '10'))
+    TIMEOUT_API: int = 10
 
     # Monitoreo
-    UMBRAL_TASA_ERROR_CRITICA = 0.5  # 50%
-    UMBRAL_TASA_ERROR_ALTA = 0.2  # 20%
-    UMBRAL_TIMEOUT_OPERADOR = 300  # 5 minutos
+    UMBRAL_TASA_ERROR_CRITICA: float = 0.5  # 50%
+    UMBRAL_TASA_ERROR_ALTA: float = 0.2  # 20%
+    UMBRAL_TIMEOUT_OPERADOR: int = 300  # 5 minutos
 
     # Logging
-    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
-    LOG_FILE = os.environ.get('LOG_FILE', 'sms_marketing.log')
+    LOG_LEVEL: str = 'INFO'
+    LOG_FILE: str = 'sms_marketing.log'
 
     # Features
-    HABILITAR_WEBHOOKS = os.environ.get('HABILITAR_WEBHOOKS', 'True') == 'True'
-    HABILITAR_REINTENTOS = os.environ.get('HABILITAR_REINTENTOS', 'True') == 'True'
-    HABILITAR_MULTI_OPERADOR = os.environ.get('HABILITAR_MULTI_OPERADOR', 'True') == 'True'
+    HABILITAR_WEBHOOKS: bool = True
+    HABILITAR_REINTENTOS: bool = True
+    HABILITAR_MULTI_OPERADOR: bool = True
 
     # Desarrollo
-    DEBUG = os.environ.get('DEBUG', 'False') == 'True'
-
-
-class ConfigDesarrollo(Config):
-    """Configuración para desarrollo"""
-    DEBUG = True
-    LOG_LEVEL = 'DEBUG'
-    MAX_SMS_POR_MINUTO = 50  # Más lento en desarrollo
-
-
-class ConfigProduccion(Config):
-    """Configuración para producción"""
-    DEBUG = False
-    LOG_LEVEL = 'INFO'
-    MAX_SMS_POR_MINUTO = 200
-    HABILITAR_WEBHOOKS = True
-    HABILITAR_REINTENTOS = True
+    DEBUG: bool = False
+
+    @classmethod
+    def desde_entorno(cls) -> 'Config':
+        """
+        Construye la configuración leyendo las variables de entorno
+
+        Las variables no definidas conservan el valor por defecto del campo.
+        """
+        campos = cls.__dataclass_fields__
+        valores = {}
+        for nombre, variable in VARIABLES_ENTORNO.items():
+            crudo = os.environ.get(variable)
+            if crudo is None:
+                continue
+            tipo = campos[nombre].type
+            if tipo is bool:
+                valores[nombre] = crudo == 'True'
+            elif tipo is int:
+                valores[nombre] = int(crudo)
+            else:
+                valores[nombre] = crudo
+        return cls(**valores)
+
+
+# Campo de Config -> variable de entorno que lo sobrescribe
+VARIABLES_ENTORNO = {
+    'DB_PATH': 'SMS_DB_PATH',
+    'URL_ACORTADOR': 'URL_ACORTADOR',
+    'MAX_SMS_POR_MINUTO': 'MAX_SMS_POR_MINUTO',
+    'MAX_SMS_POR_SEGUNDO': 'MAX_SMS_POR_SEGUNDO',
+    'MAX_REINTENTOS': 'MAX_REINTENTOS',
+    'TIMEOUT_API': 'TIMEOUT_API_SEGUNDOS',
+    'LOG_LEVEL': 'LOG_LEVEL',
+    'LOG_FILE': 'LOG_FILE',
+    'HABILITAR_WEBHOOKS': 'HABILITAR_WEBHOOKS',
+    'HABILITAR_REINTENTOS': 'HABILITAR_REINTENTOS',
+    'HABILITAR_MULTI_OPERADOR': 'HABILITAR_MULTI_OPERADOR',
+    'DEBUG': 'DEBUG',
+}
+
+
+# Configuración para desarrollo
+CONFIG_DESARROLLO = {
+    'DEBUG': True,
+    'LOG_LEVEL': 'DEBUG',
+    'MAX_SMS_POR_MINUTO': 50,  # Más lento en desarrollo
+}
+
+# Configuración para producción
+CONFIG_PRODUCCION = {
+    'DEBUG': False,
+    'LOG_LEVEL': 'INFO',
+    'MAX_SMS_POR_MINUTO': 200,
+    'HABILITAR_WEBHOOKS': True,
+    'HABILITAR_REINTENTOS': True,
+}
 
 
 # Seleccionar configuración activa
 ambiente = os.environ.get('AMBIENTE', 'desarrollo').lower()
 
 if ambiente == 'produccion':
-    config_activa = ConfigProduccion()
+    config_activa = replace(Config.desde_entorno(), **CONFIG_PRODUCCION)
 else:
-    config_activa = ConfigDesarrollo()
+    config_activa = replace(Config.desde_entorno(), **CONFIG_DESARROLLO)
@@ -179,7 +179,7 @@ class DatabaseManager:
                           json.dumps(metadata) if metadata else None, '[]'))
 
                     queue_id = cursor.lastrowid
-                    logger.debug(f"SMS agregado a cola: {queue_id} -> {numero}")
+                    logger.debug("SMS agregado a cola: %s -> %s", queue_id, numero)
                     return queue_id
                 except sqlite3.IntegrityError:
                     logger.warning(f"SMS duplicado: {numero}")
@@ -207,79 +207,118 @@ class DatabaseManager:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
                 now = datetime.now().timestamp()
+                return self._registrar_intento(cursor, now, queue_id, operador, estado,
+                                               respuesta_api, error, tiempo_ms)
 
-                # Obtener datos actuales
-                cursor.execute('SELECT operador_history, intentos FROM sms_queue WHERE id = ?', (queue_id,))
-                row = cursor.fetchone()
-
-                if not row:
-                    logger.error(f"Queue ID no encontrado: {queue_id}")
-                    return False
-
-                # Actualizar historial de operadores
-                history = json.loads(row['operador_history']) if row['operador_history'] else []
-                history.append({
-                    'operador': operador,
-                    'intento': row['intentos'] + 1,
-                    'timestamp': now,
-                    'estado': estado,
-                    'error': error
-                })
-
-                # Determinar próximo estado
-                if estado == 'enviado':
-                    nuevo_estado = 'enviado'
-                    proximo_reintento = None
-                elif estado == 'entregado':
-                    nuevo_estado = 'entregado'
-                    proximo_reintento = None
-                else:  # error
-                    nuevo_estado = 'reintentando' if row['intentos'] + 1 < row['max_intentos'] else 'fallido'
-                    if nuevo_estado == 'reintentando':
-                        # Backoff exponencial: 1s, 5s, 30s, 5min, 30min
-                        delays = [1, 5, 30, 300, 1800]
-                        proximo_reintento = now + delays[row['intentos']]
-                    else:
-                        proximo_reintento = None
-
-                # Actualizar SMS en cola
-                cursor.execute('''
-                    UPDATE sms_queue SET
-                        estado = ?,
-                        intentos = intentos + 1,
-                        operador = ?,
-                        operador_history = ?,
-                        respuesta_ultima = ?,
-                        error_ultimo = ?,
-                        ultimo_intento = ?,
-                        proximo_reintento = ?,
-                        primer_intento = COALESCE(primer_intento, ?)
-                    WHERE id = ?
-                ''', (nuevo_estado, operador, json.dumps(history), respuesta_api,
-                      error, now, proximo_reintento, now, queue_id))
-
-                # Registrar en log
-                cursor.execute('''
-                    INSERT INTO sms_log
-                    (queue_id, numero, operador, estado, intento_numero, timestamp, respuesta_api, error, tiempo_respuesta_ms)
-                    SELECT id, numero, ?, ?, intentos + 1, ?, ?, ?, ?
-                    FROM sms_queue WHERE id = ?
-                ''', (operador, estado, now, respuesta_api, error, tiempo_ms, queue_id))
+    def actualizar_intentos_bulk(self, intentos):
+        """
+        Actualiza varios intentos de envío en una sola transacción
 
-                # Actualizar estadísticas del operador
-                cursor.execute('''
-                    INSERT INTO operator_stats (operador, actualizado) VALUES (?, ?)
-                    ON CONFLICT(operador) DO UPDATE SET
-                        total_enviados = total_enviados + 1,
-                        ultimo_error_timestamp = CASE WHEN ? = 'error' THEN ? ELSE ultimo_error_timestamp END,
-                        ultimo_error = CASE WHEN ? = 'error' THEN ? ELSE ultimo_error END,
-                        ultimo_exito_timestamp = CASE WHEN ? IN ('enviado', 'entregado') THEN ? ELSE ultimo_exito_timestamp END,
-                        actualizado = ?
-                ''', (operador, now, estado, now, estado, error,
-                      estado, now, now))
-
-                logger.info(f"SMS {queue_id} actualizado: {operador} -> {nuevo_estado}")
-                return True
+        Args:
+            intentos: Lista de tuplas (queue_id, operador, estado, respuesta_api, error, tiempo_ms)
+
+        Returns:
+            Número de intentos registrados
+        """
+        if not intentos:
+            return 0
+
+        with db_lock:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                now = datetime.now().timestamp()
+                actualizados = 0
+                # Transacción explícita: los savepoints quedan anidados y se hace un solo commit
+                cursor.execute('BEGIN')
+                for queue_id, operador, estado, respuesta_api, error, tiempo_ms in intentos:
+                    # Savepoint por fila: un intento inválido no deshace el resto del lote
+                    cursor.execute('SAVEPOINT intento')
+                    try:
+                        if self._registrar_intento(cursor, now, queue_id, operador, estado,
+                                                   respuesta_api, error, tiempo_ms):
+                            actualizados += 1
+                    except Exception as e:
+                        cursor.execute('ROLLBACK TO intento')
+                        logger.error("Error registrando intento de SMS %s: %s", queue_id, e)
+                    cursor.execute('RELEASE intento')
+
+                logger.info("%d intentos registrados en lote", actualizados)
+                return actualizados
+
+    def _registrar_intento(self, cursor, now, queue_id, operador, estado, respuesta_api, error, tiempo_ms):
+        """Registra un intento dentro de una transacción abierta (cola, log y stats)"""
+        # Obtener datos actuales
+        cursor.execute('SELECT operador_history, intentos, max_intentos FROM sms_queue WHERE id = ?', (queue_id,))
+        row = cursor.fetchone()
+
+        if not row:
+            logger.error(f"Queue ID no encontrado: {queue_id}")
+            return False
+
+        # Actualizar historial de operadores
+        history = json.loads(row['operador_history']) if row['operador_history'] else []
+        history.append({
+            'operador': operador,
+            'intento': row['intentos'] + 1,
+            'timestamp': now,
+            'estado': estado,
+            'error': error
+        })
+
+        # Determinar próximo estado
+        if estado == 'enviado':
+            nuevo_estado = 'enviado'
+            proximo_reintento = None
+        elif estado == 'entregado':
+            nuevo_estado = 'entregado'
+            proximo_reintento = None
+        else:  # error
+            nuevo_estado = 'reintentando' if row['intentos'] + 1 < row['max_intentos'] else 'fallido'
+            if nuevo_estado == 'reintentando':
+                # Backoff exponencial: 1s, 5s, 30s, 5min, 30min
+                delays = [1, 5, 30, 300, 1800]
+                proximo_reintento = now + delays[row['intentos']]
+            else:
+                proximo_reintento = None
+
+        # Actualizar SMS en cola
+        cursor.execute('''
+            UPDATE sms_queue SET
+                estado = ?,
+                intentos = intentos + 1,
+                operador = ?,
+                operador_history = ?,
+                respuesta_ultima = ?,
+                error_ultimo = ?,
+                ultimo_intento = ?,
+                proximo_reintento = ?,
+                primer_intento = COALESCE(primer_intento, ?)
+            WHERE id = ?
+        ''', (nuevo_estado, operador, json.dumps(history), respuesta_api,
+              error, now, proximo_reintento, now, queue_id))
+
+        # Registrar en log
+        cursor.execute('''
+            INSERT INTO sms_log
+            (queue_id, numero, operador, estado, intento_numero, timestamp, respuesta_api, error, tiempo_respuesta_ms)
+            SELECT id, numero, ?, ?, intentos + 1, ?, ?, ?, ?
+            FROM sms_queue WHERE id = ?
+        ''', (operador, estado, now, respuesta_api, error, tiempo_ms, queue_id))
+
+        # Actualizar estadísticas del operador
+        cursor.execute('''
+            INSERT INTO operator_stats (operador, actualizado) VALUES (?, ?)
+            ON CONFLICT(operador) DO UPDATE SET
+                total_enviados = total_enviados + 1,
+                ultimo_error_timestamp = CASE WHEN ? = 'error' THEN ? ELSE ultimo_error_timestamp END,
+                ultimo_error = CASE WHEN ? = 'error' THEN ? ELSE ultimo_error END,
+                ultimo_exito_timestamp = CASE WHEN ? IN ('enviado', 'entregado') THEN ? ELSE ultimo_exito_timestamp END,
+                actualizado = ?
+        ''', (operador, now, estado, now, estado, error,
+              estado, now, now))
+
+        logger.info("SMS %s actualizado: %s -> %s", queue_id, operador, nuevo_estado)
+        return True
 
     def confirmar_entrega(self, numero, codigo_error=None):
         """Marca un SMS como entregado (llamado por webhook del operador)"""
@@ -317,6 +356,10 @@ class DatabaseManager:
             row = cursor.fetchone()
             return dict(row) if row else None
 
+    def obtener_stats_todos_operadores(self):
+        """Obtiene estadísticas de todos los operadores indexadas por nombre (una sola consulta)"""
+        return {stats['operador']: stats for stats in self.obtener_todas_stats()}
+
     def obtener_todas_stats(self):
         """Obtiene estadísticas de todos los operadores"""
         with self.get_connection() as conn:
@@ -6,19 +6,31 @@ Gestiona múltiples proveedores de SMS con fallover automático
 import hashlib
 import json
 import logging
-from datetime import datetime
-from typing import Optional, Dict, List
-import pytz
+import time
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+from typing import Optional, Dict, List, Tuple
+from config import config_activa
 from database import db
+from rate_limiter import RateLimiter
 
 logger = logging.getLogger(__name__)
 
+# Zona horaria de la API (Asia/Shanghai: UTC+8 fijo, sin horario de verano)
+_TZ_SHANGHAI = timezone(timedelta(hours=8))
+
 class OperadorConfig:
     """Configuración de un operador de SMS"""
 
-    def __init__(self, operador, url_api, cuenta, contraseña, sender_id,
-                 prioridad=1, max_por_minuto=100, max_reintentos=5,
-                 timeout_segundos=10, habilitado=True):
+    # Sin __dict__ por instancia: menos memoria y acceso a atributos más rápido
+    __slots__ = ('operador', 'url_api', 'cuenta', 'contraseña', 'sender_id',
+                 'prioridad', 'max_por_minuto', 'max_reintentos', 'timeout_segundos',
+                 'habilitado', 'cache_ttl_seconds', '_cred_prefix_bytes',
+                 '_sign_cache', '_sign_lock')
+
+    def __init__(self, operador: str, url_api: str, cuenta: str, contraseña: str, sender_id: str,
+                 prioridad: int = 1, max_por_minuto: int = 100, max_reintentos: int = 5,
+                 timeout_segundos: int = 10, habilitado: bool = True, cache_ttl_seconds: float = 0):
         self.operador = operador
         self.url_api = url_api
         self.cuenta = cuenta
@@ -29,18 +41,43 @@ class OperadorConfig:
         self.max_reintentos = max_reintentos
         self.timeout_segundos = timeout_segundos
         self.habilitado = habilitado
-
-    def generar_sign(self, timestamp=None):
+        # Segundos que se reutiliza una firma (0 = desactivado, para APIs con
+        # validación estricta del timestamp)
+        self.cache_ttl_seconds = cache_ttl_seconds
+        # Credenciales pre-codificadas (se reutilizan en cada firma)
+        self._cred_prefix_bytes: bytes = (cuenta + contraseña).encode()
+        # Última firma generada: (generada_en, sign, timestamp); -inf = nunca generada
+        self._sign_cache: Tuple[float, str, str] = (float('-inf'), '', '')
+        self._sign_lock = Lock()
+
+    def generar_sign(self, timestamp: Optional[str] = None) -> Tuple[str, str]:
         """Genera firma MD5 requerida por la API (formato específico del operador)"""
-        if timestamp is None:
-            zona = pytz.timezone("Asia/Shanghai")
-            timestamp = datetime.now(zona).strftime('%Y%m%d%H%M%S')
-
-        texto = self.cuenta + self.contraseña + timestamp
-        sign = hashlib.md5(texto.encode()).hexdigest()
-        return sign, timestamp
-
-    def to_dict(self):
+        if timestamp is not None:
+            return self._calcular_sign(timestamp)
+
+        if self.cache_ttl_seconds <= 0:
+            return self._calcular_sign(datetime.now(_TZ_SHANGHAI).strftime('%Y%m%d%H%M%S'))
+
+        # Reutilizar la firma mientras el timestamp siga dentro de la ventana aceptada
+        ahora = time.monotonic()
+        generada_en, sign, ts = self._sign_cache
+        if ahora - generada_en < self.cache_ttl_seconds:
+            return sign, ts
+
+        with self._sign_lock:
+            generada_en, sign, ts = self._sign_cache
+            if ahora - generada_en >= self.cache_ttl_seconds:
+                sign, ts = self._calcular_sign(datetime.now(_TZ_SHANGHAI).strftime('%Y%m%d%H%M%S'))
+                self._sign_cache = (ahora, sign, ts)
+            return sign, ts
+
+    def _calcular_sign(self, timestamp: str) -> Tuple[str, str]:
+        """Calcula la firma MD5 de cuenta + contraseña + timestamp"""
+        h = hashlib.md5(self._cred_prefix_bytes)
+        h.update(timestamp.encode())
+        return h.hexdigest(), timestamp
+
+    def to_dict(self) -> Dict:
         """Convierte a diccionario"""
         return {
             'operador': self.operador,
@@ -54,6 +91,16 @@ class OperadorConfig:
 class OperadorRouter:
     """Gestor de operadores con enrutamiento inteligente"""
 
+    # Segundos que se reutilizan las estadísticas (el dashboard consulta seguido)
+    STATS_TTL_SEGUNDOS = 15
+
+    # Latencia promedio (ms) que equivale a bajar un nivel de prioridad
+    LATENCIA_MS_POR_PRIORIDAD = 1000.0
+    # Peso de la última muestra en el promedio móvil exponencial de latencia
+    PESO_LATENCIA = 0.1
+    # Fallos consecutivos que abren el circuit breaker de un operador
+    FALLOS_PARA_ABRIR = 5
+
     # Detección automática de operador por prefijos
     OPERADOR_PREFIJOS = {
         'movistar': ['310', '311', '320', '321'],  # Movistar Colombia
@@ -93,48 +140,195 @@ class OperadorRouter:
         )
     }
 
-    def __init__(self):
+    def __init__(self) -> None:
         self.operadores: Dict[str, OperadorConfig] = self.OPERADORES_PREDEFINIDOS.copy()
+        self._habilitados_sorted: Tuple[OperadorConfig, ...] = ()
+        self._rebuild_habilitados()
+        # Cache de estadísticas: (expira_en, stats)
+        self._stats_cache: Tuple[float, List[Dict]] = (0.0, [])
+        # Rate limiters por operador (creados de antemano, sin carreras entre hilos)
+        self._limiters_lock = Lock()
+        self.rate_limiters: Dict[str, RateLimiter] = {
+            nombre: RateLimiter(op.max_por_minuto) for nombre, op in self.operadores.items()
+        }
+        # Salud de operadores: latencia EWMA (ms), último error (time.monotonic) y circuit breaker
+        # {'state': closed|open|half-open, 'opened_at': time.monotonic, 'fail_count': int,
+        #  'probe_in_flight': bool}
+        self._salud_lock = Lock()
+        self._latency_ewma: Dict[str, float] = {}
+        self._ultimo_error: Dict[str, float] = {}
+        self._breaker: Dict[str, Dict] = {}
         logger.info(f"Router iniciado con {len(self.operadores)} operadores")
 
+    def _rebuild_habilitados(self) -> None:
+        """Recalcula la lista de operadores habilitados ordenada por prioridad"""
+        self._habilitados_sorted = tuple(sorted(
+            (op for op in self.operadores.values() if op.habilitado),
+            key=lambda x: x.prioridad
+        ))
+        # La configuración cambió: invalidar estadísticas cacheadas
+        self._stats_cache = (0.0, [])
+
+    def ensure_limiter(self, nombre: str) -> RateLimiter:
+        """Obtiene el rate limiter de un operador, creándolo si no existe"""
+        limiter = self.rate_limiters.get(nombre)
+        if limiter is None:
+            with self._limiters_lock:
+                limiter = self.rate_limiters.get(nombre)
+                if limiter is None:
+                    limiter = RateLimiter(self.operadores[nombre].max_por_minuto)
+                    self.rate_limiters[nombre] = limiter
+        return limiter
+
     def detectar_operador_por_numero(self, numero: str) -> str:
         """Detecta el operador probable basado en el número celular"""
         numero = numero.strip()
         if numero.startswith('57'):
             numero = numero[2:]
 
-        # Primeros 3 dígitos
-        prefijo = numero[:3]
-
-        for operador, prefijos in self.OPERADOR_PREFIJOS.items():
-            if prefijo in prefijos:
-                return operador
+        # Primeros 3 dígitos ('principal' por defecto)
+        return _prefix_to_op(numero[:3])
 
-        return 'principal'  # Por defecto
-
-    def obtener_operador_siguiente(self, intento: int, operador_fallido: Optional[str] = None) -> OperadorConfig:
+    def obtener_operador_siguiente(self, intento: int,
+                                   operador_fallido: Optional[str] = None) -> Optional[OperadorConfig]:
         """
         Obtiene el siguiente operador a usar (con fallover inteligente)
 
         Estrategia:
-        1. Primer intento: operador detectado o principal
-        2. Reintentos: alternar entre operadores disponibles
+        1. Descartar operadores con el circuit breaker abierto (durante UMBRAL_TIMEOUT_OPERADOR
+           segundos; después pasan a half-open y reciben un único envío de prueba,
+           reservado en reservar_envio al momento de enviar)
+        2. En reintentos, descartar operador_fallido si queda otra alternativa
+        3. Entre los que no tuvieron errores en los últimos UMBRAL_TIMEOUT_OPERADOR
+           segundos, elegir el de menor prioridad ajustada por latencia promedio
+        4. Si todos fallaron recientemente: alternar entre los candidatos según intento
+        5. Si todos tienen el circuito abierto: None (el SMS queda en cola hasta el próximo ciclo)
         """
-        operadores_habilitados = [
-            op for op in self.operadores.values()
-            if op.habilitado
-        ]
+        # Habilitados ya ordenados por prioridad (se recalculan solo al cambiar)
+        operadores_habilitados = self._habilitados_sorted
 
         if not operadores_habilitados:
             logger.error("No hay operadores habilitados!")
             return self.operadores['principal']
 
-        # Ordenar por prioridad
-        operadores_habilitados.sort(key=lambda x: x.prioridad)
+        with self._salud_lock:
+            return self._seleccionar(operadores_habilitados, intento, operador_fallido)
+
+    def _seleccionar(self, operadores_habilitados: Tuple[OperadorConfig, ...], intento: int,
+                     operador_fallido: Optional[str]) -> Optional[OperadorConfig]:
+        """Aplica la estrategia de obtener_operador_siguiente (requiere _salud_lock)"""
+        ahora = time.monotonic()
+        umbral = config_activa.UMBRAL_TIMEOUT_OPERADOR
+
+        candidatos = [
+            op for op in operadores_habilitados
+            if self._circuito_disponible(op.operador, ahora, umbral)
+        ]
+
+        if not candidatos:
+            logger.warning("Todos los operadores habilitados tienen el circuit breaker abierto")
+            return None
+
+        # Reintento: cambiar de operador si hay alternativa
+        if intento > 0 and operador_fallido:
+            alternativas = [op for op in candidatos if op.operador != operador_fallido]
+            if alternativas:
+                candidatos = alternativas
+
+        ultimo_error = self._ultimo_error
+        sanos = [
+            op for op in candidatos
+            if ahora - ultimo_error.get(op.operador, float('-inf')) >= umbral
+        ]
+
+        if not sanos:
+            return candidatos[intento % len(candidatos)]
 
-        # Seleccionar operador basado en intento
-        idx = intento % len(operadores_habilitados)
-        return operadores_habilitados[idx]
+        # Prioridad ajustada: los operadores lentos pierden niveles (empates -> orden de prioridad)
+        latencias = self._latency_ewma
+        return min(
+            sanos,
+            key=lambda op: op.prioridad + latencias.get(op.operador, 0.0) / self.LATENCIA_MS_POR_PRIORIDAD
+        )
+
+    def _circuito_disponible(self, nombre: str, ahora: float, umbral: float) -> bool:
+        """
+        Indica si el circuit breaker del operador permite enviar (requiere _salud_lock)
+
+        open pasa a half-open al vencer la ventana; en half-open solo se permite
+        una prueba en curso hasta que registrar_exito/registrar_error la resuelva.
+        """
+        breaker = self._breaker.get(nombre)
+        if breaker is None or breaker['state'] == 'closed':
+            return True
+
+        if breaker['state'] == 'open':
+            if ahora - breaker['opened_at'] < umbral:
+                return False
+            breaker['state'] = 'half-open'
+            logger.info(f"Circuit breaker de {nombre} en half-open: enviando prueba")
+
+        return not breaker['probe_in_flight']
+
+    def reservar_envio(self, nombre: str) -> Tuple[bool, bool]:
+        """
+        Autoriza un envío según el circuit breaker del operador
+
+        Retorna (permitido, es_prueba). Con el circuito abierto se rechaza; en
+        half-open el primer envío reserva la prueba y los demás se rechazan hasta
+        que se resuelva. Quien reserva debe llamar a liberar_prueba al terminar.
+        """
+        with self._salud_lock:
+            if not self._circuito_disponible(nombre, time.monotonic(), config_activa.UMBRAL_TIMEOUT_OPERADOR):
+                return False, False
+
+            breaker = self._breaker.get(nombre)
+            if breaker is None or breaker['state'] != 'half-open':
+                return True, False
+            breaker['probe_in_flight'] = True
+            return True, True
+
+    def liberar_prueba(self, nombre: str) -> None:
+        """Libera la prueba half-open reservada con reservar_envio (no-op si ya se resolvió)"""
+        with self._salud_lock:
+            breaker = self._breaker.get(nombre)
+            if breaker is not None and breaker['state'] == 'half-open':
+                breaker['probe_in_flight'] = False
+
+    def registrar_exito(self, nombre: str, tiempo_ms: int) -> None:
+        """Actualiza la latencia promedio (EWMA) y cierra el circuit breaker tras un envío exitoso"""
+        with self._salud_lock:
+            breaker = self._breaker.get(nombre)
+            if breaker is not None:
+                if breaker['state'] != 'closed':
+                    logger.info(f"Circuit breaker de {nombre} cerrado")
+                breaker['state'] = 'closed'
+                breaker['fail_count'] = 0
+                breaker['probe_in_flight'] = False
+
+            previa = self._latency_ewma.get(nombre)
+            if previa is None:
+                self._latency_ewma[nombre] = float(tiempo_ms)
+            else:
+                self._latency_ewma[nombre] = (1 - self.PESO_LATENCIA) * previa + self.PESO_LATENCIA * tiempo_ms
+
+    def registrar_error(self, nombre: str) -> None:
+        """Cuenta un fallo del operador; abre el circuit breaker al llegar a FALLOS_PARA_ABRIR"""
+        with self._salud_lock:
+            self._ultimo_error[nombre] = time.monotonic()
+            breaker = self._breaker.setdefault(
+                nombre, {'state': 'closed', 'opened_at': 0.0, 'fail_count': 0, 'probe_in_flight': False}
+            )
+            breaker['fail_count'] += 1
+            breaker['probe_in_flight'] = False
+
+            # En half-open basta un fallo de la prueba para volver a abrir
+            if breaker['state'] == 'half-open' or (
+                breaker['state'] == 'closed' and breaker['fail_count'] >= self.FALLOS_PARA_ABRIR
+            ):
+                breaker['state'] = 'open'
+                breaker['opened_at'] = time.monotonic()
+                logger.warning(f"Circuit breaker de {nombre} abierto tras {breaker['fail_count']} fallos")
 
     def obtener_operador(self, nombre: str) -> Optional[OperadorConfig]:
         """Obtiene configuración de un operador específico"""
@@ -144,24 +338,35 @@ class OperadorRouter:
         """Lista todos los operadores disponibles"""
         return [op.to_dict() for op in self.operadores.values()]
 
-    def habilitar_operador(self, nombre: str, habilitado: bool = True):
+    def habilitar_operador(self, nombre: str, habilitado: bool = True) -> bool:
         """Habilita o deshabilita un operador"""
         if nombre in self.operadores:
             self.operadores[nombre].habilitado = habilitado
+            self._rebuild_habilitados()
             logger.info(f"Operador {nombre} {'habilitado' if habilitado else 'deshabilitado'}")
             return True
         return False
 
-    def agregar_operador(self, config: OperadorConfig):
+    def agregar_operador(self, config: OperadorConfig) -> None:
         """Agrega un operador personalizado"""
         self.operadores[config.operador] = config
+        self.ensure_limiter(config.operador)
+        self._rebuild_habilitados()
         logger.info(f"Operador agregado: {config.operador}")
 
     def obtener_stats_operadores(self) -> List[Dict]:
-        """Obtiene estadísticas de todos los operadores"""
+        """Obtiene estadísticas de todos los operadores (cacheadas STATS_TTL_SEGUNDOS)"""
+        ahora = time.monotonic()
+        expira_en, stats_cacheadas = self._stats_cache
+        if ahora < expira_en:
+            return stats_cacheadas
+
+        # Una sola consulta para todos los operadores
+        todas_stats = db.obtener_stats_todos_operadores()
+
         stats = []
         for nombre, operador in self.operadores.items():
-            db_stats = db.obtener_stats_operador(nombre)
+            db_stats = todas_stats.get(nombre)
             stat = operador.to_dict()
 
             if db_stats:
@@ -185,8 +390,26 @@ class OperadorRouter:
 
             stats.append(stat)
 
-        return sorted(stats, key=lambda x: x['prioridad'])
+        stats.sort(key=lambda x: x['prioridad'])
+        self._stats_cache = (ahora + self.STATS_TTL_SEGUNDOS, stats)
+        return stats
+
+
+# Índice invertido prefijo -> operador, calculado una sola vez al importar
+_PREFIJO_A_OPERADOR: Dict[str, str] = {
+    prefijo: operador
+    for operador, prefijos in OperadorRouter.OPERADOR_PREFIJOS.items()
+    for prefijo in prefijos
+}
+
+
+def _prefix_to_op(prefijo: str) -> str:
+    """Operador asociado a un prefijo de 3 dígitos ('principal' por defecto)"""
+    return _PREFIJO_A_OPERADOR.get(prefijo, 'principal')
 
 
 # Instancia global
 router = OperadorRouter()
+
+# Rate limiters por operador
+rate_limiters = router.rate_limiters
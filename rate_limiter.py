@@ -54,7 +54,7 @@ class RateLimiter:
             if self.tokens < 1:
                 # Calcular tiempo de espera
                 tiempo_espera = (1 - self.tokens) * (60.0 / self.max_por_minuto)
-                logger.debug(f"Rate limit: esperando {tiempo_espera:.2f}s")
+                logger.debug("Rate limit: esperando %.2fs", tiempo_espera)
                 time.sleep(tiempo_espera)
                 self._refill()
 
@@ -131,7 +131,7 @@ class RateLimiterGlobal:
 
             if self.tokens < 1:
                 tiempo_espera = (1 - self.tokens) / self.max_sms_por_segundo
-                logger.debug(f"Global rate limit: esperando {tiempo_espera:.2f}s")
+                logger.debug("Global rate limit: esperando %.2fs", tiempo_espera)
                 time.sleep(tiempo_espera)
                 self.tokens = 0
 
@@ -4,18 +4,125 @@ Implementa backoff exponencial, multi-operador y rate limiting adaptativo
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+import orjson
 import logging
+import re
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Dict, Optional, Tuple
+from functools import lru_cache
+from threading import Lock
+from typing import Any, Deque, Dict, FrozenSet, List, NamedTuple, Optional, Tuple
 from database import db
-from operators import router
-from rate_limiter import RateLimiter
+from operators import OperadorConfig, router, rate_limiters
 
 logger = logging.getLogger(__name__)
 
-# Rate limiters por operador
-rate_limiters = {}
+# Sesiones HTTP por operador (keep-alive: reutiliza conexiones TCP entre envíos)
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = Lock()
+
+# Cabeceras para cuerpos serializados con orjson
+_JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Placeholders de plantilla: {columna_csv}, {link}
+_PLACEHOLDER_RE = re.compile(r'\{([^{}]+)\}')
+
+
+def obtener_sesion(operador_nombre: str) -> requests.Session:
+    """Obtiene (o crea una vez) la sesión HTTP con pool de conexiones del operador"""
+    sess = _sessions.get(operador_nombre)
+    if sess is None:
+        with _sessions_lock:
+            sess = _sessions.get(operador_nombre)
+            if sess is None:
+                sess = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=0)
+                sess.mount('http://', adapter)
+                sess.mount('https://', adapter)
+                _sessions[operador_nombre] = sess
+    return sess
+
+
+@dataclass(slots=True)
+class PreparedSMS:
+    """SMS listo para enviar: número con prefijo de país y contenido ya procesado"""
+    queue_id: int
+    numero: str
+    numero_e164: str
+    content: str
+    operador_name: str
+    intento: int = 0
+
+
+class SendResult(NamedTuple):
+    """Resultado de un envío (tupla inmutable, más liviana que un dict por SMS)"""
+    success: bool
+    numero: str
+    operador: str
+    data: Any  # Respuesta de la API si success, mensaje de error si no
+    tiempo_ms: int = 0
+
+    @property
+    def error(self) -> Optional[str]:
+        """Mensaje de error (None si el envío fue exitoso)"""
+        return None if self.success else self.data
+
+    def to_dict(self) -> Dict:
+        """Convierte al formato de diccionario usado en las respuestas JSON"""
+        if self.success:
+            return {
+                "success": True,
+                "numero": self.numero,
+                "operador": self.operador,
+                "respuesta": self.data,
+                "tiempo_ms": self.tiempo_ms
+            }
+        return {
+            "success": False,
+            "numero": self.numero,
+            "operador": self.operador,
+            "error": self.data
+        }
+
+
+def formatear_numero(numero: str) -> str:
+    """Agrega prefijo de país (57) si no existe"""
+    return numero if numero.startswith('57') else "57" + numero
+
+
+def _registrar_intento(buffer_db: Optional[Deque], queue_id: int, operador_nombre: str, estado: str,
+                       respuesta_api: Optional[str] = None, error: Optional[str] = None,
+                       tiempo_ms: Optional[int] = None) -> None:
+    """Registra el intento en BD, o lo acumula en buffer_db para escribirlo en lote"""
+    if buffer_db is None:
+        db.actualizar_intento(queue_id, operador_nombre, estado,
+                              respuesta_api=respuesta_api, error=error, tiempo_ms=tiempo_ms)
+    else:
+        buffer_db.append((queue_id, operador_nombre, estado, respuesta_api, error, tiempo_ms))
+
+
+def _vaciar_buffer_db(buffer_db: Deque) -> bool:
+    """
+    Escribe en BD (una transacción) los intentos acumulados en buffer_db
+
+    Si la escritura falla, los intentos vuelven al inicio de buffer_db para el
+    próximo vaciado. Retorna True si se escribieron.
+    """
+    filas = []
+    while buffer_db:
+        filas.append(buffer_db.popleft())
+
+    try:
+        db.actualizar_intentos_bulk(filas)
+        return True
+    except Exception as e:
+        buffer_db.extendleft(reversed(filas))
+        logger.error("No se pudieron registrar %d intentos en BD, se reintentará: %s", len(filas), e)
+        return False
 
 
 def acortar_url_tinyurl(url_larga: str) -> str:
@@ -123,82 +230,197 @@ class SMSSender:
     # Configuración de backoff exponencial (segundos)
     BACKOFF_DELAYS = [1, 5, 30, 300, 1800]  # 1s, 5s, 30s, 5min, 30min
 
+    # Envíos concurrentes por lote (I/O-bound; el rate limiter de cada operador acota el ritmo)
+    MAX_WORKERS = 32
+
+    # Escritura de resultados en BD: se hace commit cada N intentos o cada N segundos,
+    # lo que ocurra primero, para acotar el tiempo que un SMS ya enviado sigue pendiente
+    ESCRITURAS_POR_COMMIT = 10
+    SEGUNDOS_ENTRE_COMMITS = 1.0
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def compilar_template(mensaje: str) -> Tuple[Tuple[str, ...], FrozenSet[str]]:
+        """
+        Compila una plantilla una sola vez (cacheada por texto del mensaje)
+
+        Retorna (partes, claves): partes alterna texto literal y nombre de
+        variable (índices impares), claves es el conjunto de variables usadas.
+        """
+        partes = tuple(_PLACEHOLDER_RE.split(mensaje))
+        return partes, frozenset(partes[1::2])
+
     @staticmethod
-    def preparar_mensaje(mensaje: str, numero: str, row_data: Optional[Dict] = None, link_dinamico: Optional[str] = None) -> str:
+    def preparar_mensaje(mensaje: str, numero: str, row_data: Optional[Dict[str, Any]] = None,
+                         link_dinamico: Optional[str] = None) -> str:
         """
         Prepara el mensaje reemplazando variables y acortando URLs
 
         Variables soportadas:
         - {columna_csv}: Reemplazado con valor del CSV
         - {link}: Reemplazado con URL acortada
+
+        Las variables sin valor se dejan intactas en el mensaje.
         """
-        mensaje_final = mensaje
+        # Caso común (envíos transaccionales): nada que reemplazar
+        if not row_data and not link_dinamico:
+            return mensaje
+        if '{' not in mensaje:
+            return mensaje
+
+        partes, claves = SMSSender.compilar_template(mensaje)
 
         # Reemplazar variables de datos
+        valores: Dict[str, str] = {}
         if row_data:
-            for columna, valor in row_data.items():
-                placeholder = "{" + columna + "}"
-                if placeholder in mensaje_final:
-                    mensaje_final = mensaje_final.replace(placeholder, str(valor))
+            for columna in claves:
+                if columna in row_data:
+                    valores[columna] = str(row_data[columna])
 
         # Reemplazar link dinámico CON ACORTAMIENTO ✨ NUEVO
-        if link_dinamico and '{link}' in mensaje_final:
-            logger.debug(f"Acortando URL para {numero}: {link_dinamico[:50]}...")
+        if link_dinamico and 'link' in claves and 'link' not in valores:
+            logger.debug("Acortando URL para %s: %.50s...", numero, link_dinamico)
             # Acortar la URL antes de insertar
-            link_acortado = acortar_url(link_dinamico)
-            mensaje_final = mensaje_final.replace('{link}', link_acortado)
-            logger.info(f"URL acortada en mensaje para {numero}")
+            valores['link'] = acortar_url(link_dinamico)
+            logger.info("URL acortada en mensaje para %s", numero)
+
+        if not valores:
+            return mensaje
+
+        # Una sola pasada sobre la plantilla compilada
+        salida = list(partes)
+        for i in range(1, len(salida), 2):
+            clave = salida[i]
+            salida[i] = valores.get(clave, '{' + clave + '}')
+        return ''.join(salida)
+
+    @staticmethod
+    def preparar_sms(queue_id: int, numero: str, mensaje: str, operador_nombre: str,
+                     row_data: Optional[Dict[str, Any]] = None, link_dinamico: Optional[str] = None) -> PreparedSMS:
+        """Formatea el número y procesa variables del mensaje (sin tocar la red del operador)"""
+        return PreparedSMS(
+            queue_id,
+            numero,
+            formatear_numero(numero),
+            SMSSender.preparar_mensaje(mensaje, numero, row_data, link_dinamico),
+            operador_nombre
+        )
 
-        return mensaje_final
+    @staticmethod
+    def _rechazar_vacio(prep: PreparedSMS, buffer_db: Optional[Deque] = None) -> SendResult:
+        """Registra como error un SMS cuyo contenido quedó vacío"""
+        logger.error("Mensaje vacío para %s", prep.numero)
+        _registrar_intento(buffer_db, prep.queue_id, prep.operador_name, 'error',
+                           error="Mensaje vacío después de procesar variables")
+        return SendResult(
+            False,
+            prep.numero,
+            prep.operador_name,
+            "Mensaje vacío"
+        )
+
+    @staticmethod
+    def preparar_lote(pendientes: List[Dict], buffer_db: Optional[Deque] = None) -> List[PreparedSMS]:
+        """
+        Prepara un lote de SMS de la cola antes de enviarlos
+
+        Formatea números y procesa plantillas en una sola pasada; los mensajes
+        vacíos se registran como error y se descartan. El operador se elige
+        al enviar cada SMS (ver _procesar_item), con la salud de operadores al día.
+        operador_name queda con el operador del intento anterior.
+        """
+        lote: List[PreparedSMS] = []
+        for item in pendientes:
+            prep = SMSSender.preparar_sms(item['id'], item['numero'], item['mensaje'], item['operador'])
+            prep.intento = item['intentos']
+
+            # Validar longitud
+            if len(prep.content) == 0:
+                SMSSender._rechazar_vacio(prep, buffer_db)
+                continue
+
+            lote.append(prep)
+
+        return lote
 
     @staticmethod
     def enviar_sms_ahora(queue_id: int, numero: str, mensaje: str,
-                         operador_nombre: str, row_data: Optional[Dict] = None,
-                         link_dinamico: Optional[str] = None) -> Dict:
+                         operador_nombre: str, row_data: Optional[Dict[str, Any]] = None,
+                         link_dinamico: Optional[str] = None,
+                         buffer_db: Optional[Deque] = None) -> SendResult:
         """
         Envía un SMS inmediatamente a través del operador especificado
 
-        Retorna:
-        {
-            "success": bool,
-            "numero": str,
-            "operador": str,
-            "respuesta": dict,
-            "tiempo_ms": int
-        }
+        Si se pasa buffer_db, el resultado no se escribe en BD sino que se
+        acumula en esa cola para db.actualizar_intentos_bulk()
+
+        Retorna un SendResult (success, numero, operador, data, tiempo_ms);
+        data es la respuesta de la API o el mensaje de error.
         """
+        if not router.obtener_operador(operador_nombre):
+            logger.error("Operador no encontrado: %s", operador_nombre)
+            return SendResult(
+                False,
+                numero,
+                operador_nombre,
+                "Operador no existe"
+            )
+
+        # Preparar mensaje
+        prep = SMSSender.preparar_sms(queue_id, numero, mensaje, operador_nombre, row_data, link_dinamico)
+
+        # Validar longitud
+        if len(prep.content) == 0:
+            return SMSSender._rechazar_vacio(prep, buffer_db)
+
+        return SMSSender.enviar_preparado(prep, buffer_db)
+
+    @staticmethod
+    def enviar_preparado(prep: PreparedSMS, buffer_db: Optional[Deque] = None) -> SendResult:
+        """Envía un SMS ya preparado: solo rate limiting, firma y petición HTTP"""
+        queue_id = prep.queue_id
+        numero = prep.numero
+        operador_nombre = prep.operador_name
         operador = router.obtener_operador(operador_nombre)
 
         if not operador:
-            logger.error(f"Operador no encontrado: {operador_nombre}")
-            return {
-                "success": False,
-                "numero": numero,
-                "operador": operador_nombre,
-                "error": "Operador no existe"
-            }
+            logger.error("Operador no encontrado: %s", operador_nombre)
+            return SendResult(
+                False,
+                numero,
+                operador_nombre,
+                "Operador no existe"
+            )
 
-        # Preparar mensaje
-        mensaje_procesado = SMSSender.preparar_mensaje(mensaje, numero, row_data, link_dinamico)
+        # Circuit breaker: en half-open solo pasa un envío de prueba a la vez
+        permitido, es_prueba = router.reservar_envio(operador_nombre)
+        if not permitido:
+            logger.warning("[%s] Circuit breaker abierto o en prueba, %s queda en cola",
+                           operador_nombre, numero)
+            return SendResult(
+                False,
+                numero,
+                operador_nombre,
+                "Operador no disponible"
+            )
 
-        # Validar longitud
-        if len(mensaje_procesado) == 0:
-            logger.error(f"Mensaje vacío para {numero}")
-            db.actualizar_intento(queue_id, operador_nombre, 'error',
-                                error="Mensaje vacío después de procesar variables")
-            return {
-                "success": False,
-                "numero": numero,
-                "operador": operador_nombre,
-                "error": "Mensaje vacío"
-            }
+        try:
+            return SMSSender._enviar_http(prep, operador, buffer_db)
+        finally:
+            # Liberar la prueba si no se resolvió (excepción antes de registrar el resultado)
+            if es_prueba:
+                router.liberar_prueba(operador_nombre)
 
-        # Rate limiting
-        if operador_nombre not in rate_limiters:
-            rate_limiters[operador_nombre] = RateLimiter(operador.max_por_minuto)
+    @staticmethod
+    def _enviar_http(prep: PreparedSMS, operador: OperadorConfig,
+                     buffer_db: Optional[Deque] = None) -> SendResult:
+        """Rate limiting, firma y petición HTTP al operador; registra el resultado"""
+        queue_id = prep.queue_id
+        numero = prep.numero
+        operador_nombre = prep.operador_name
 
-        limiter = rate_limiters[operador_nombre]
-        limiter.esperar()
+        # Rate limiting
+        rate_limiters[operador_nombre].esperar()
 
         # Construir parámetros de API
         sign, timestamp = operador.generar_sign()
@@ -209,22 +431,20 @@ class SMSSender:
             "datetime": timestamp
         }
 
-        # Agregar prefijo de país si no existe
-        numero_formateado = "57" + numero if not numero.startswith('57') else numero
-
         data = {
             "senderid": operador.sender_id,
-            "numbers": numero_formateado,
-            "content": mensaje_procesado
+            "numbers": prep.numero_e164,
+            "content": prep.content
         }
 
         inicio = time.time()
 
         try:
-            response = requests.post(
+            response = obtener_sesion(operador_nombre).post(
                 operador.url_api,
                 params=params,
-                json=data,
+                data=orjson.dumps(data),
+                headers=_JSON_HEADERS,
                 timeout=operador.timeout_segundos
             )
 
@@ -232,14 +452,16 @@ class SMSSender:
 
             # Intentar parsear respuesta
             try:
-                respuesta = response.json()
-            except:
+                respuesta = orjson.loads(response.content)
+            except orjson.JSONDecodeError:
                 respuesta = {"text": response.text, "status_code": response.status_code}
 
-            logger.info(f"[{operador_nombre}] Enviado a {numero} en {tiempo_ms}ms")
+            logger.info("[%s] Enviado a %s en %dms", operador_nombre, numero, tiempo_ms)
+            router.registrar_exito(operador_nombre, tiempo_ms)
 
             # Actualizar en BD
-            db.actualizar_intento(
+            _registrar_intento(
+                buffer_db,
                 queue_id,
                 operador_nombre,
                 'enviado',
@@ -247,61 +469,141 @@ class SMSSender:
                 tiempo_ms=tiempo_ms
             )
 
-            return {
-                "success": True,
-                "numero": numero,
-                "operador": operador_nombre,
-                "respuesta": respuesta,
-                "tiempo_ms": tiempo_ms
-            }
+            return SendResult(
+                True,
+                numero,
+                operador_nombre,
+                respuesta,
+                tiempo_ms
+            )
 
         except requests.Timeout:
-            logger.error(f"[{operador_nombre}] Timeout enviando a {numero}")
-            db.actualizar_intento(
+            logger.error("[%s] Timeout enviando a %s", operador_nombre, numero)
+            router.registrar_error(operador_nombre)
+            _registrar_intento(
+                buffer_db,
                 queue_id,
                 operador_nombre,
                 'error',
                 error="Timeout de conexión"
             )
-            return {
-                "success": False,
-                "numero": numero,
-                "operador": operador_nombre,
-                "error": "Timeout"
-            }
+            return SendResult(
+                False,
+                numero,
+                operador_nombre,
+                "Timeout"
+            )
 
         except requests.RequestException as e:
-            logger.error(f"[{operador_nombre}] Error HTTP enviando a {numero}: {e}")
-            db.actualizar_intento(
+            logger.error("[%s] Error HTTP enviando a %s: %s", operador_nombre, numero, e)
+            router.registrar_error(operador_nombre)
+            _registrar_intento(
+                buffer_db,
                 queue_id,
                 operador_nombre,
                 'error',
                 error=str(e)
             )
-            return {
-                "success": False,
-                "numero": numero,
-                "operador": operador_nombre,
-                "error": str(e)
-            }
+            return SendResult(
+                False,
+                numero,
+                operador_nombre,
+                str(e)
+            )
 
         except Exception as e:
-            logger.error(f"[{operador_nombre}] Error inesperado: {e}")
-            db.actualizar_intento(
+            logger.error("[%s] Error inesperado: %s", operador_nombre, e)
+            router.registrar_error(operador_nombre)
+            _registrar_intento(
+                buffer_db,
                 queue_id,
                 operador_nombre,
                 'error',
                 error=str(e)
             )
-            return {
-                "success": False,
-                "numero": numero,
-                "operador": operador_nombre,
-                "error": str(e)
-            }
+            return SendResult(
+                False,
+                numero,
+                operador_nombre,
+                str(e)
+            )
 
     @staticmethod
-    def procesar_cola():
+    def _procesar_item(prep: PreparedSMS, buffer_db: Optional[Deque] = None,
+                       reintento: bool = False) -> SendResult:
+        """Selecciona operador y envía un SMS preparado de la cola (ejecutado en el pool de hilos)"""
+        # Seleccionar operador siguiente (al momento del envío, no al preparar el lote)
+        operador = router.obtener_operador_siguiente(prep.intento, prep.operador_name)
+        if operador is None:
+            # Circuit breaker abierto en todos: no gastar el timeout, queda en cola
+            logger.warning("Sin operadores disponibles, SMS %s queda en cola", prep.queue_id)
+            return SendResult(
+                False,
+                prep.numero,
+                prep.operador_name,
+                "Sin operadores disponibles"
+            )
+        prep.operador_name = operador.operador
+
+        if reintento:
+            logger.info("Reintentando SMS %s (intento %d) con %s",
+                        prep.queue_id, prep.intento + 1, operador.operador)
+        else:
+            logger.debug("Reintento %d para %s con %s", prep.intento + 1, prep.numero, operador.operador)
+
+        resultado = SMSSender.enviar_preparado(prep, buffer_db)
+
+        # Log del resultado
+        if resultado.success:
+            logger.info("✓ %s enviado con %s", prep.numero, prep.operador_name)
+        else:
+            logger.warning("✗ %s falló: %s", prep.numero, resultado.error or 'Unknown')
+
+        return resultado
+
+    @staticmethod
+    def _enviar_lote(pendientes: List[Dict], reintento: bool = False) -> None:
+        """
+        Prepara y envía un lote de la cola, escribiendo resultados en BD por tandas
+
+        Entrega al-menos-una-vez: un SMS enviado cuyo resultado aún no se ha
+        escrito sigue como pendiente/reintentando en BD, y otro proceso (o un
+        reinicio) puede volver a enviarlo. La ventana se acota a
+        ESCRITURAS_POR_COMMIT intentos o SEGUNDOS_ENTRE_COMMITS segundos.
+        """
+        # deque: los hilos agregan y el hilo principal vacía sin bloqueos adicionales
+        buffer_db = deque()
+        ultimo_commit = time.monotonic()
+        try:
+            lote = SMSSender.preparar_lote(pendientes, buffer_db)
+            if lote:
+                # Envíos concurrentes: el trabajo es de red, los hilos solapan las esperas
+                with ThreadPoolExecutor(max_workers=min(SMSSender.MAX_WORKERS, len(lote))) as ex:
+                    futuros = [
+                        ex.submit(SMSSender._procesar_item, prep, buffer_db, reintento)
+                        for prep in lote
+                    ]
+                    for futuro in as_completed(futuros):
+                        try:
+                            futuro.result()
+                        except Exception as e:
+                            # El SMS queda en la cola y se reintenta en el próximo ciclo
+                            logger.error("Error inesperado procesando SMS del lote: %s", e)
+
+                        ahora = time.monotonic()
+                        if (len(buffer_db) >= SMSSender.ESCRITURAS_POR_COMMIT
+                                or ahora - ultimo_commit >= SMSSender.SEGUNDOS_ENTRE_COMMITS):
+                            _vaciar_buffer_db(buffer_db)
+                            ultimo_commit = ahora
+        finally:
+            # Último vaciado: un reintento si la BD estaba ocupada
+            if not _vaciar_buffer_db(buffer_db):
+                time.sleep(SMSSender.SEGUNDOS_ENTRE_COMMITS)
+                if not _vaciar_buffer_db(buffer_db):
+                    logger.error("%d intentos enviados quedaron sin registrar en BD", len(buffer_db))
+
+    @staticmethod
+    def procesar_cola() -> None:
         """
         Procesa SMS pendientes de la cola
         Se ejecuta en segundo plano periódicamente
@@ -311,59 +613,18 @@ class SMSSender:
         if not pendientes:
             return
 
-        logger.info(f"Procesando {len(pendientes)} SMS pendientes")
-
-        for item in pendientes:
-            queue_id = item['id']
-            numero = item['numero']
-            mensaje = item['mensaje']
-            intento = item['intentos']
-
-            # Seleccionar operador siguiente
-            operador = router.obtener_operador_siguiente(intento, item['operador'])
+        logger.info("Procesando %d SMS pendientes", len(pendientes))
 
-            logger.debug(f"Reintento {intento + 1} para {numero} con {operador.operador}")
-
-            # Enviar
-            resultado = SMSSender.enviar_sms_ahora(
-                queue_id,
-                numero,
-                mensaje,
-                operador.operador
-            )
-
-            # Log del resultado
-            if resultado['success']:
-                logger.info(f"✓ {numero} enviado con {operador.operador}")
-            else:
-                logger.warning(f"✗ {numero} falló: {resultado.get('error', 'Unknown')}")
+        SMSSender._enviar_lote(pendientes)
 
     @staticmethod
-    def reintentar_fallidos():
-        """Procesa SMS que necesitan reintentarse"""
+    def reintentar_fallidos() -> None:
+        """Procesa SMS que necesitan reintentarse (cambiando de operador en cada reintento)"""
         pendientes = db.obtener_pendientes(limit=100)
 
-        reintentos_iniciados = 0
+        reintentos = [item for item in pendientes if item['estado'] == 'reintentando']
 
-        for item in pendientes:
-            if item['estado'] == 'reintentando':
-                reintentos_iniciados += 1
-                queue_id = item['id']
-                numero = item['numero']
-                mensaje = item['mensaje']
-                intento = item['intentos']
-
-                # Cambiar operador en cada reintento
-                operador = router.obtener_operador_siguiente(intento)
-
-                logger.info(f"Reintentando SMS {queue_id} (intento {intento + 1}) con {operador.operador}")
-
-                SMSSender.enviar_sms_ahora(
-                    queue_id,
-                    numero,
-                    mensaje,
-                    operador.operador
-                )
-
-        if reintentos_iniciados > 0:
-            logger.info(f"Iniciados {reintentos_iniciados} reintentos")
+        if reintentos:
+            SMSSender._enviar_lote(reintentos, reintento=True)
+
+            logger.info("Iniciados %d reintentos", len(reintentos))